@@ -1,13 +1,64 @@
 import uuid
+from collections import defaultdict
+
+
+def latest(msgs):
+    """
+    Merge policy for targets whose messages are full snapshots.
+    """
+    return msgs[-1]
 
 
 class Comm(object):
     on_recv = None
 
-    def __init__(self, target, on_recv):
-        self.uuid = uuid.uuid4().hex
+    def __init__(self, target, on_recv, comm_id=None):
+        self.uuid = comm_id or uuid.uuid4().hex
         self.target = target
         self.on_recv = on_recv
 
     def __str__(self):
         return self.target
+
+
+class CommManager(object):
+    """
+    Registry of open comms, indexed by id and by target.
+    """
+
+    def __init__(self):
+        self.comms = {}
+        self.by_target = defaultdict(dict)
+        self.handlers = {}
+        self.merge = {}
+
+    def register_target(self, target, on_recv, merge=None):
+        self.handlers[target] = on_recv
+        if merge:
+            self.merge[target] = merge
+
+    def open(self, target, comm_id=None):
+        comm = Comm(target, self.handlers[target], comm_id)
+        self.comms[comm.uuid] = comm
+        self.by_target[target][comm.uuid] = comm
+        return comm
+
+    def close(self, comm_id):
+        comm = self.comms.pop(comm_id, None)
+        if comm:
+            targets = self.by_target[comm.target]
+            targets.pop(comm_id, None)
+            if not targets:
+                del self.by_target[comm.target]
+        return comm
+
+    def for_target(self, target=None):
+        if target is None:
+            return list(self.comms.values())
+        return list(self.by_target.get(target, {}).values())
+
+    def __contains__(self, comm_id):
+        return comm_id in self.comms
+
+    def __getitem__(self, comm_id):
+        return self.comms[comm_id]
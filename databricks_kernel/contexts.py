@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+CONTEXTS_PATH = Path.home() / ".jupyter" / "databricks_contexts.json"
+
+
+def notebook_id(kernel_key):
+    """
+    Identify the notebook a kernel belongs to. Recent jupyter servers pass the
+    notebook path; otherwise fall back to the connection key, which is kept
+    when a kernel is restarted.
+    """
+    session = os.environ.get("JPY_SESSION_NAME")
+    if session:
+        return session
+    return hashlib.sha256(kernel_key.encode()).hexdigest()[:16]
+
+
+def load_contexts():
+    # writes replace the file atomically, so reading needs no lock
+    if not CONTEXTS_PATH.exists():
+        return {}
+
+    with CONTEXTS_PATH.open() as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+
+
+def _lock(f):
+    if fcntl:
+        fcntl.flock(f, fcntl.LOCK_EX)
+    elif msvcrt:
+        # blocks, retrying every second for up to 10 seconds
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def _unlock(f):
+    if fcntl:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    elif msvcrt:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def locked_contexts():
+    """
+    Yield the saved contexts while holding an exclusive lock, and write them
+    back afterwards, so concurrent kernels don't overwrite each other's
+    entries. Don't await while holding the lock.
+    """
+    CONTEXTS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with CONTEXTS_PATH.with_suffix(".lock").open("w") as lock:
+        _lock(lock)
+        try:
+            saved = load_contexts()
+            yield saved
+
+            tmp = CONTEXTS_PATH.with_suffix(".tmp")
+            with tmp.open("w") as f:
+                json.dump(saved, f)
+            os.replace(tmp, CONTEXTS_PATH)
+        finally:
+            _unlock(lock)
@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import aiohttp
+
+from .exceptions import DaemonError
+
+logger = logging.getLogger("asyncio")
+logger.setLevel(logging.DEBUG)
+
+SOCKET_PATH = Path.home() / ".jupyter" / "databricks_daemon.sock"
+
+
+class Daemon(object):
+    """
+    Host-level daemon shared by all kernels. It owns a single connection pool
+    and caches the cluster list per workspace. Command status polls are not
+    routed through it: command ids are unique to a kernel's context, so there
+    is nothing to share.
+    """
+
+    cluster_ttl = 4
+
+    def __init__(self, path=SOCKET_PATH):
+        self.path = Path(path)
+        self.connector = None
+        self.sessions = {}
+        self.clusters = {}
+
+    def _session(self, uri, api_key):
+        key = (uri, api_key)
+        if key not in self.sessions:
+            self.sessions[key] = aiohttp.ClientSession(
+                connector=self.connector,
+                connector_owner=False,
+                headers={"Authorization": f"Bearer {api_key}"},
+            )
+        return self.sessions[key]
+
+    async def _get(self, uri, api_key, path, params=None):
+        session = self._session(uri, api_key)
+        async with session.get(f"{uri}{path}", params=params) as r:
+            if r.status >= 400:
+                raise DaemonError(r.status, await r.text())
+            return await r.json()
+
+    async def clusters_list(self, uri, api_key):
+        """
+        Return the cluster list together with the time it was requested, which
+        may be up to cluster_ttl seconds ago.
+        """
+        key = (uri, api_key)
+        fetched_at, future = self.clusters.get(key, (0, None))
+
+        expired = time.time() - fetched_at > self.cluster_ttl
+        failed = future and future.done() and future.exception()
+        if not future or (future.done() and expired) or failed:
+            fetched_at = time.time()
+            future = asyncio.ensure_future(
+                self._get(uri, api_key, "/api/2.0/clusters/list")
+            )
+            self.clusters[key] = (fetched_at, future)
+
+        return {"fetched_at": fetched_at, "body": await asyncio.shield(future)}
+
+    async def _dispatch(self, request):
+        op = request["op"]
+        if op == "ping":
+            return "pong"
+        elif op == "clusters_list":
+            return await self.clusters_list(request["uri"], request["api_key"])
+        raise DaemonError(400, f"Unknown operation {op}")
+
+    async def _handle_request(self, request, writer):
+        response = {"id": request.get("id")}
+        try:
+            response["result"] = await self._dispatch(request)
+        except DaemonError as e:
+            response.update(status=e.status, error=e.message)
+        except Exception as e:
+            response.update(status=500, error=str(e))
+
+        if not writer.is_closing():
+            writer.write(json.dumps(response).encode() + b"\n")
+
+    async def _handle_client(self, reader, writer):
+        tasks = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+            except ValueError:
+                logger.warn("Daemon received invalid request")
+                continue
+            tasks.add(asyncio.ensure_future(self._handle_request(request, writer)))
+            tasks = {t for t in tasks if not t.done()}
+
+        for task in tasks:
+            task.cancel()
+        writer.close()
+
+    async def serve(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.exists():
+            self.path.unlink()
+
+        self.connector = aiohttp.TCPConnector(limit=100)
+        server = await asyncio.start_unix_server(self._handle_client, str(self.path))
+        os.chmod(self.path, 0o600)
+        logger.info(f"Databricks daemon listening on {self.path}")
+
+        try:
+            await server.serve_forever()
+        finally:
+            for session in self.sessions.values():
+                await session.close()
+            await self.connector.close()
+            self.path.unlink()
+
+
+class DaemonClient(object):
+    """
+    Connection from a kernel to the host daemon.
+    """
+
+    def __init__(self, path=SOCKET_PATH):
+        self.path = Path(path)
+        self.reader = None
+        self.writer = None
+        self.pending = {}
+        self.ids = itertools.count()
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(str(self.path))
+        asyncio.ensure_future(self._read_responses())
+        await self.request("ping")
+
+    async def _read_responses(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self.pending.pop(response["id"], None)
+                if not future or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(
+                        DaemonError(response["status"], response["error"])
+                    )
+                else:
+                    future.set_result(response["result"])
+        finally:
+            self.writer.close()
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Daemon disconnected"))
+            self.pending = {}
+
+    async def request(self, op, **kwargs):
+        if not self.connected:
+            raise ConnectionError("Daemon not connected")
+
+        request_id = next(self.ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(json.dumps({"id": request_id, "op": op, **kwargs}).encode())
+        self.writer.write(b"\n")
+        return await future
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", help="Unix socket path", default=SOCKET_PATH)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(Daemon(args.socket).serve())
@@ -1,21 +1,32 @@
 import asyncio
+import base64
+import inspect
 import json
 import logging
 import re
+import shlex
+import shutil
+import time
 from json.decoder import JSONDecodeError
 from pathlib import Path
 
 import aiohttp
 
-from . import magics
-from .comm import Comm
+from . import contexts, magics
+from .comm import latest
+from .daemon import SOCKET_PATH, DaemonClient
 from .exceptions import (
     ClusterNotOnlineException,
     CommandCanceled,
     CommandError,
+    CommandTimeout,
     IncompleteResults,
+    MissingDependency,
     NoSuchMagic,
+    ResizeTimeout,
 )
+from .result_store import RESULTS_PATH, ResultStore
+from .transfer import DBFS_BLOCK_SIZE
 from .utils import Config
 from . import html
 
@@ -32,36 +43,105 @@ def get_cluster_state(clusters, cluster_id):
 
 class DatabricksMixin(object):
     _config_path = Path.home() / ".jupyter" / "databricks.json"
+    _timeouts_path = Path.home() / ".jupyter" / "databricks_timeouts.jsonl"
     _context_id = None
+    _context_creation = None
+    _context_seen_at = 0
+    _clusters = []
+    _clusters_fetched_at = 0
+    # how long a resize may take to show up as "resizing"
+    _resize_start_timeout = 30
+    # how long a resize may take to finish
+    _resize_timeout = 30 * 60
 
     config = Config({})
     session = None
+    daemon = None
+    results = None
 
-    async def _build_session(self):
-        if self.session:
-            await self.session.close()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cluster_starts = {}
+        self._cluster_waiters = []
 
-        self.session = aiohttp.ClientSession(
+    async def _build_session(self):
+        # swap in the new session before closing the old one, so nothing picks
+        # up a closed session in between
+        previous, self.session = self.session, aiohttp.ClientSession(
             headers={"Authorization": f"Bearer {self.config.api_key}"}
         )
+        if previous:
+            await previous.close()
+
+    async def _connect_daemon(self):
+        path = Path(self.config.daemon_socket or SOCKET_PATH)
+        if not path.exists():
+            return
+
+        client = DaemonClient(path)
+        try:
+            await client.connect()
+        except OSError as e:
+            logger.info(f"Daemon not available, using direct mode: {e}")
+            return
+
+        self.daemon = client
+        logger.info(f"Connected to daemon at {path}")
+
+    async def _daemon_request(self, op, **kwargs):
+        """
+        Run a request through the host daemon. Returns None when there is no
+        daemon, in which case the caller should talk to Databricks directly.
+        """
+        if not self.daemon:
+            return None
+
+        try:
+            return await self.daemon.request(
+                op, uri=self.config.uri, api_key=self.config.api_key, **kwargs
+            )
+        except ConnectionError:
+            logger.warn("Lost connection to daemon, falling back to direct mode")
+            self.daemon = None
+            return None
+
+    async def _create_context(self):
+        async with self.session.post(
+            f"{self.config.uri}/api/1.2/contexts/create",
+            json={"language": self.language, "clusterId": self.config.cluster_id},
+        ) as r:
+            r.raise_for_status()
+            body = await r.json()
+
+        if self.config.reattach_context:
+            self._save_context(body["id"])
+        return body["id"]
 
     async def _get_or_create_context_id(self):
         if not self._context_id:
-            async with self.session.post(
-                f"{self.config.uri}/api/1.2/contexts/create",
-                json={"language": self.language, "clusterId": self.config.cluster_id},
-            ) as r:
-
-                r.raise_for_status()
-                body = await r.json()
-                self._context_id = body["id"]
+            # share one pending creation between concurrent callers
+            if not self._context_creation or self._context_creation.done():
+                self._context_creation = asyncio.ensure_future(self._create_context())
+            self._context_id = await asyncio.shield(self._context_creation)
 
         return self._context_id
 
-    async def _fetch_cluster_list(self):
-        async with self.session.get(f"{self.config.uri}/api/2.0/clusters/list") as r:
-            r.raise_for_status()
-            results = await r.json()
+    async def _fetch_cluster_list(self, fresh=False):
+        """
+        Fetch the cluster list, through the daemon unless fresh is set. The
+        daemon may answer from its cache, so its lists count as fetched when
+        the daemon requested them.
+        """
+        started = time.time()
+        cached = None if fresh else await self._daemon_request("clusters_list")
+        if cached is None:
+            async with self.session.get(
+                f"{self.config.uri}/api/2.0/clusters/list"
+            ) as r:
+                r.raise_for_status()
+                results = await r.json()
+        else:
+            started, results = cached["fetched_at"], cached["body"]
 
         clusters = [
             {
@@ -72,34 +152,215 @@ class DatabricksMixin(object):
             for x in results["clusters"]
         ]
 
+        self._clusters = clusters
+        self._clusters_fetched_at = time.time()
+        self._notify_cluster_waiters(clusters, started)
         return clusters
 
+    def _notify_cluster_waiters(self, clusters, fetched_at):
+        for cluster_id, until, since, future in self._cluster_waiters:
+            state = get_cluster_state(clusters, cluster_id)
+            if not future.done() and fetched_at >= since and until(state):
+                future.set_result(state)
+
+    async def _wait_for_cluster_state(self, cluster_id, until, since=0, timeout=None):
+        """
+        Wait until until(state) holds for the cluster and return the state, or
+        None after timeout seconds. Every cluster list fetch that started after
+        since, including the periodic one of the session loop, resolves the
+        wait as soon as the state matches; in between the list is refreshed
+        with an increasing interval.
+        """
+        future = asyncio.get_event_loop().create_future()
+        waiter = (cluster_id, until, since, future)
+        self._cluster_waiters.append(waiter)
+
+        deadline = time.time() + timeout if timeout else None
+        interval = 1
+        prev_state = get_cluster_state(self._clusters, cluster_id)
+        try:
+            while not future.done():
+                clusters = await self._fetch_cluster_list(fresh=bool(since))
+                state = get_cluster_state(clusters, cluster_id)
+                if state != prev_state:
+                    self.send_comm_message(
+                        "databricks.config", self._config_message(clusters)
+                    )
+                prev_state = state
+
+                if deadline:
+                    if time.time() >= deadline:
+                        return None
+                    interval = min(interval, deadline - time.time())
+
+                await asyncio.wait([future], timeout=interval)
+                interval = min(interval * 2, 10)
+
+            return future.result()
+        finally:
+            self._cluster_waiters.remove(waiter)
+
+    def _is_known_online(self):
+        """
+        Whether the last fetched cluster list, if recent enough, shows the
+        cluster as online.
+        """
+        age = time.time() - self._clusters_fetched_at
+        state = get_cluster_state(self._clusters, self.config.cluster_id)
+        return age < self.config.cluster_state_ttl and state in ["running", "resizing"]
+
     async def _start_cluster(self, cluster_id):
-        clusters = await self._fetch_cluster_list()
-        state = prev_state = get_cluster_state(clusters, cluster_id)
+        # lists fetched before this point may show a state the cluster has left
+        since = time.time()
+        state = await self._wait_for_cluster_state(
+            cluster_id, lambda x: x != "terminating", since=since
+        )
 
-        async with self.session.post(
-            f"{self.config.uri}/api/2.0/clusters/start",
-            json={"cluster_id": cluster_id},
+        if state == "terminated":
+            since = time.time()
+            async with self.session.post(
+                f"{self.config.uri}/api/2.0/clusters/start",
+                json={"cluster_id": cluster_id},
+            ) as r:
+                r.raise_for_status()
+            state = await self._wait_for_cluster_state(
+                cluster_id, lambda x: x != "terminated", since=since
+            )
+
+        if state:
+            state = await self._wait_for_cluster_state(
+                cluster_id,
+                lambda x: x in ["running", "terminated", "error", False],
+                since=since,
+            )
+
+        if state != "running":
+            raise ClusterNotOnlineException()
+
+        # create the context right away, so the first command doesn't wait for it
+        if cluster_id == self.config.cluster_id:
+            await self._get_or_create_context_id()
+
+    def _log_task_error(self, task):
+        if not task.cancelled() and task.exception():
+            logger.warn(f"Cluster action failed: {task.exception()}")
+
+    def _ensure_cluster_started(self, cluster_id):
+        """
+        Start the cluster in the background. Returns the task that completes
+        once the cluster is running.
+        """
+        task = self._cluster_starts.get(cluster_id)
+        if not task or task.done():
+            task = asyncio.ensure_future(self._start_cluster(cluster_id))
+            task.add_done_callback(self._log_task_error)
+            self._cluster_starts[cluster_id] = task
+        return task
+
+    async def _wait_for_cluster(self):
+        task = self._cluster_starts.get(self.config.cluster_id)
+        if not task or task.done():
+            # a cluster that is already coming up (started from the UI or by
+            # another kernel) is waited for; only starting one needs autostart
+            state = get_cluster_state(self._clusters, self.config.cluster_id)
+            stopped = state in ["terminated", "terminating", "error", False]
+            if stopped and not self.config.autostart_cluster:
+                raise ClusterNotOnlineException()
+            task = self._ensure_cluster_started(self.config.cluster_id)
+
+        self.log("Waiting for the cluster to start...\n")
+        # other cells may be waiting for the same start
+        await self._interruptible(asyncio.shield(task))
+
+    async def _interruptible(self, awaitable):
+        """
+        Await awaitable, cancelling it and raising CommandCanceled when the
+        kernel is interrupted in the meantime.
+        """
+        task = asyncio.ensure_future(awaitable)
+        try:
+            while not task.done():
+                await asyncio.wait([task], timeout=1)
+                if self.interrupt_execution:
+                    raise CommandCanceled()
+            return task.result()
+        finally:
+            task.cancel()
+
+    async def _get_cluster(self, cluster_id):
+        async with self.session.get(
+            f"{self.config.uri}/api/2.0/clusters/get", params={"cluster_id": cluster_id}
         ) as r:
             r.raise_for_status()
+            return await r.json()
 
-            while state != "running":
-                await asyncio.sleep(2)
-                clusters = await self._fetch_cluster_list()
-                state = get_cluster_state(clusters, cluster_id)
-                if prev_state != state:
-                    self.send_comm_message(
-                        "databricks.config", await self._config_changed()
-                    )
+    async def _resize_cluster(self, cluster_id, size, wait=True):
+        """
+        Resize the cluster to size, either {"num_workers": n} or
+        {"autoscale": {...}}, and return its previous size in the same form.
+        """
+        cluster = await self._get_cluster(cluster_id)
+        if "autoscale" in cluster:
+            previous = {"autoscale": cluster["autoscale"]}
+        else:
+            previous = {"num_workers": cluster.get("num_workers", 0)}
 
-                prev_state = state
+        if size == previous:
+            return previous
+
+        requested = time.time()
+        async with self.session.post(
+            f"{self.config.uri}/api/2.0/clusters/resize",
+            json={"cluster_id": cluster_id, **size},
+        ) as r:
+            r.raise_for_status()
+
+        if wait:
+            await self._wait_for_resize(cluster_id, requested)
+
+        return previous
+
+    async def _wait_for_resize(self, cluster_id, since):
+        """
+        Wait until a resize requested at since is done. Interrupting the
+        kernel stops the wait, not the resize.
+        """
+        # only lists fetched after the request count, so a stale "running"
+        # doesn't end the wait before the resize has started
+        state = await self._interruptible(
+            self._wait_for_cluster_state(
+                cluster_id,
+                lambda x: x != "running",
+                since=since,
+                timeout=self._resize_start_timeout,
+            )
+        )
+        # None: still running after the timeout, the resize was applied
+        # without the cluster going through "resizing"
+        if state == "resizing":
+            state = await self._interruptible(
+                self._wait_for_cluster_state(
+                    cluster_id,
+                    lambda x: x != "resizing",
+                    since=since,
+                    timeout=self._resize_timeout,
+                )
+            )
+            if state is None:
+                raise ResizeTimeout(self._resize_timeout)
+        if state not in ["running", None]:
+            raise ClusterNotOnlineException()
 
     async def _check_status(self, command_id):
         context_id = await self._get_or_create_context_id()
+        params = {
+            "clusterId": self.config.cluster_id,
+            "contextId": context_id,
+            "commandId": command_id,
+        }
 
         async with self.session.get(
-            f"{self.config.uri}/api/1.2/commands/status?clusterId={self.config.cluster_id}&contextId={context_id}&commandId={command_id}"  # noqa
+            f"{self.config.uri}/api/1.2/commands/status", params=params
         ) as r:
             r.raise_for_status()
             return await r.json()
@@ -110,17 +371,103 @@ class DatabricksMixin(object):
         state = get_cluster_state(clusters, cluster_id)
         return state in ["running", "resizing"]
 
-    async def _destroy_context(self):
-        if self.config.cluster_id and self._context_id:
+    async def _is_context_alive(self, context_id):
+        async with self.session.get(
+            f"{self.config.uri}/api/1.2/contexts/status",
+            params={"clusterId": self.config.cluster_id, "contextId": context_id},
+        ) as r:
+            if r.status >= 400:
+                return False
+            body = await r.json()
+        return body.get("status") == "Running"
+
+    async def _destroy_context(self, cluster_id=None, context_id=None):
+        cluster_id = cluster_id or self.config.cluster_id
+        context_id = context_id or self._context_id
+        if cluster_id and context_id:
             async with self.session.post(
                 f"{self.config.uri}/api/1.2/contexts/destroy",
-                json={
-                    "clusterId": self.config.cluster_id,
-                    "contextId": self._context_id,
-                },
+                json={"clusterId": cluster_id, "contextId": context_id},
             ) as r:
                 r.raise_for_status()
 
+    async def _leave_context(self):
+        """
+        Drop the context of the current cluster, including one still being
+        created, before switching to another cluster.
+        """
+        if self._context_creation and not self._context_creation.done():
+            self._context_creation.cancel()
+        self._context_creation = None
+
+        context_id, self._context_id = self._context_id, None
+        if not context_id:
+            return
+
+        try:
+            await self._destroy_context(context_id=context_id)
+        except aiohttp.ClientError as e:
+            logger.warn(f"Could not destroy context {context_id}: {e}")
+        if self.config.reattach_context:
+            self._forget_context()
+
+    def _context_key(self):
+        notebook = contexts.notebook_id(self.jupyter_config.key)
+        return f"{notebook}:{self.language}:{self.config.cluster_id}"
+
+    def _save_context(self, context_id):
+        with contexts.locked_contexts() as saved:
+            saved[self._context_key()] = {
+                "uri": self.config.uri,
+                "cluster_id": self.config.cluster_id,
+                "context_id": context_id,
+                "last_seen": time.time(),
+            }
+        self._context_seen_at = time.time()
+
+    def _forget_context(self):
+        with contexts.locked_contexts() as saved:
+            saved.pop(self._context_key(), None)
+
+    def _touch_context(self):
+        """
+        Mark the saved context as in use, so other kernels don't clean it up.
+        """
+        interval = self.config.context_ttl / 4
+        if self._context_id and time.time() - self._context_seen_at > interval:
+            self._save_context(self._context_id)
+
+    async def _reattach_context(self):
+        saved = contexts.load_contexts().get(self._context_key())
+        if not saved or saved["uri"] != self.config.uri:
+            return
+
+        if await self._is_context_alive(saved["context_id"]):
+            self._context_id = saved["context_id"]
+            self._save_context(self._context_id)
+            logger.info(f"Reattached to context {self._context_id}")
+
+    async def _cleanup_contexts(self):
+        """
+        Destroy saved contexts of this workspace that have not been used or
+        reattached to within context_ttl.
+        """
+        # take the expired entries out under the lock, destroy them after
+        with contexts.locked_contexts() as saved:
+            expired = [
+                saved.pop(key)
+                for key, x in list(saved.items())
+                if x["uri"] == self.config.uri
+                and x["context_id"] != self._context_id
+                and time.time() - x["last_seen"] > self.config.context_ttl
+            ]
+
+        for x in expired:
+            try:
+                await self._destroy_context(x["cluster_id"], x["context_id"])
+            except aiohttp.ClientError as e:
+                logger.info(f"Could not destroy context {x['context_id']}: {e}")
+
     async def _cancel_command(self, command_id):
         command_status = await self._check_status(command_id)
 
@@ -139,17 +486,69 @@ class DatabricksMixin(object):
             ) as r:
                 r.raise_for_status()
 
+    async def _dbfs(self, endpoint, **payload):
+        async with self.session.post(
+            f"{self.config.uri}/api/2.0/dbfs/{endpoint}", json=payload
+        ) as r:
+            r.raise_for_status()
+            return await r.json()
+
+    async def _dbfs_read(self, path, offset, length):
+        async with self.session.get(
+            f"{self.config.uri}/api/2.0/dbfs/read",
+            params={"path": path, "offset": offset, "length": length},
+        ) as r:
+            r.raise_for_status()
+            body = await r.json()
+        return base64.b64decode(body["data"])
+
+    async def _dbfs_put(self, path, data):
+        if len(data) <= DBFS_BLOCK_SIZE:
+            await self._dbfs(
+                "put",
+                path=path,
+                contents=base64.b64encode(data).decode(),
+                overwrite=True,
+            )
+            return
+
+        handle = (await self._dbfs("create", path=path, overwrite=True))["handle"]
+        for i in range(0, len(data), DBFS_BLOCK_SIZE):
+            block = base64.b64encode(data[i : i + DBFS_BLOCK_SIZE]).decode()
+            await self._dbfs("add-block", handle=handle, data=block)
+        await self._dbfs("close", handle=handle)
+
+    async def _dbfs_write_file(self, path, local_path, offset, length, progress):
+        """
+        Stream length bytes of a local file, starting at offset, to a DBFS file
+        one block at a time.
+        """
+        handle = (await self._dbfs("create", path=path, overwrite=True))["handle"]
+        try:
+            with open(local_path, "rb") as f:
+                f.seek(offset)
+                while length > 0:
+                    block = f.read(min(DBFS_BLOCK_SIZE, length))
+                    if not block:
+                        break
+                    await self._dbfs(
+                        "add-block", handle=handle, data=base64.b64encode(block).decode()
+                    )
+                    length -= len(block)
+                    progress.update(len(block))
+        finally:
+            await self._dbfs("close", handle=handle)
+
     async def _config_changed(self, data=None, *args):
         if data:
             data = data["data"]
 
         if type(data) == dict:
-            self.config.update(data)
-
-            with self._config_path.open("w") as f:
-                f.write(self.config.to_json())
-
-            await self._build_session()
+            if self.execution_idle.is_set():
+                await self._apply_config(data)
+            else:
+                # don't swap the session or cluster under a running command
+                asyncio.ensure_future(self._apply_config_when_idle(data))
 
         try:
             clusters = await self._fetch_cluster_list()
@@ -160,18 +559,69 @@ class DatabricksMixin(object):
         if not self.config.cluster_id:
             self.config.cluster_id = clusters[0]["id"]
 
+        return self._config_message(clusters)
+
+    async def _apply_config(self, data):
+        if data.get("cluster_id", self.config.cluster_id) != self.config.cluster_id:
+            await self._leave_context()
+        self.config.update(data)
+
+        with self._config_path.open("w") as f:
+            f.write(self.config.to_json())
+
+        await self._build_session()
+
+    async def _apply_config_when_idle(self, data):
+        await self.wait_for_idle()
+        await self._apply_config(data)
+        self.send_comm_message("databricks.config", await self._config_changed())
+
+    def _config_message(self, clusters):
         return {
             "config": self.config.__dict__,
             "clusters": clusters,
         }
 
+    def _apply_output_config(self):
+        for key in ["stream_chunk_size", "stream_chunk_interval", "stream_max_size"]:
+            value = getattr(self.config, key)
+            if value is not None:
+                setattr(self, key, value)
+
+        if self.config.iopub_hwm:
+            self.iopub_hwm = self.config.iopub_hwm
+
+    def _init_result_store(self):
+        try:
+            self.results = ResultStore(
+                RESULTS_PATH / self.engine_id, self.config.result_store_size
+            )
+        except MissingDependency as e:
+            logger.info(f"Result store disabled: {e}")
+
+    def _store_result(self, data, headers):
+        if not self.results:
+            return
+
+        try:
+            self.results.put_rows(self.execution_count, data, headers)
+        except Exception as e:
+            logger.warn(f"Could not store result {self.execution_count}: {e}")
+
     async def _handle_actions(self, content, *args):
         action = content["data"]["action"]
         data = content["data"]["data"]
         if action == "start_cluster":
-            await self._start_cluster(data["cluster_id"])
+            self._ensure_cluster_started(data["cluster_id"])
+        elif action == "resize_cluster":
+            task = asyncio.ensure_future(
+                self._resize_cluster(
+                    data["cluster_id"], {"num_workers": data["num_workers"]}
+                )
+            )
+            task.add_done_callback(self._log_task_error)
 
-    async def init_session(self):
+    def load_config(self):
         if self._config_path.exists():
             with self._config_path.open() as f:
                 try:
@@ -179,28 +629,38 @@ class DatabricksMixin(object):
                 except (JSONDecodeError, TypeError):
                     logger.warn("Could not read")
 
+        self._apply_output_config()
+
+    async def init_session(self):
+        self._init_result_store()
         await self._build_session()
+        await self._connect_daemon()
 
-        self.comms.update(
-            **{
-                x.uuid: x
-                for x in [
-                    Comm("databricks.config", self._config_changed),
-                    Comm("databricks.actions", self._handle_actions),
-                ]
-            }
+        if self.config.reattach_context:
+            try:
+                await self._reattach_context()
+                await self._cleanup_contexts()
+            except aiohttp.ClientError as e:
+                logger.warn(f"Could not reattach to context: {e}")
+
+        self.comms.register_target(
+            "databricks.config", self._config_changed, merge=latest
         )
+        self.comms.register_target("databricks.actions", self._handle_actions)
+        self.comms.open("databricks.config")
+        self.comms.open("databricks.actions")
+
+        if self.config.warmup_cluster and self.config.cluster_id:
+            self._ensure_cluster_started(self.config.cluster_id)
 
         # periodically send new config update
         while True:
             self.send_comm_message("databricks.config", await self._config_changed())
+            if self.config.reattach_context:
+                self._touch_context()
             await asyncio.sleep(5)
 
-    async def _run_command(self, code):
-
-        if not await self._is_online_cluster():
-            raise ClusterNotOnlineException()
-
+    async def _submit_command(self, code):
         context_id = await self._get_or_create_context_id()
 
         async with self.session.post(
@@ -215,18 +675,78 @@ class DatabricksMixin(object):
             r.raise_for_status()
             body = await r.json()
 
-        command_id = body["id"]
-
-        cmd_status = await self._check_status(command_id)
-        while cmd_status["status"] in ["Running", "Queued"]:
-            cmd_status = await self._check_status(command_id)
-            await asyncio.sleep(1)
+        return body["id"]
+
+    async def _diagnose(self):
+        """
+        Check the cluster and the context concurrently, wait for the cluster
+        if it is not online and drop the context if it is gone.
+        """
+        checks = [self._is_online_cluster()]
+        if self._context_id:
+            checks.append(self._is_context_alive(self._context_id))
+
+        online, *context_alive = await asyncio.gather(*checks)
+        if not online:
+            await self._wait_for_cluster()
+        if context_alive and not context_alive[0]:
+            logger.warn(f"Context {self._context_id} is gone, creating a new one")
+            self._context_id = None
+
+    def _record_timeout(self, command_id, timeout):
+        record = {
+            "time": time.time(),
+            "notebook": contexts.notebook_id(self.jupyter_config.key),
+            "cluster_id": self.config.cluster_id,
+            "command_id": command_id,
+            "timeout": timeout,
+        }
+        logger.warn(f"Command {command_id} exceeded its deadline of {timeout}s")
+        with self._timeouts_path.open("a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    async def _wait_for_command(self, command_id, timeout=None):
+        # a timeout of 0 means no deadline
+        deadline = time.time() + timeout if timeout else None
+        interval = self.config.poll_min_interval
+        while True:
+            await asyncio.sleep(interval)
 
             if self.interrupt_execution:
                 await self._cancel_command(command_id)
                 raise CommandCanceled()
 
-        return cmd_status
+            if deadline and time.time() > deadline:
+                await self._cancel_command(command_id)
+                self._record_timeout(command_id, timeout)
+                raise CommandTimeout(timeout)
+
+            cmd_status = await self._check_status(command_id)
+            if cmd_status["status"] not in ["Running", "Queued"]:
+                return cmd_status
+
+            interval = min(interval * 2, self.config.poll_max_interval)
+
+    async def _run_command(self, code, timeout=None):
+        started = time.time()
+
+        # submit right away when the cluster is known to be online, and only
+        # look into the cluster and context when that fails
+        if self._is_known_online():
+            try:
+                command_id = await self._submit_command(code)
+            except aiohttp.ClientResponseError as e:
+                logger.info(f"Submitting command failed ({e}), checking cluster")
+                await self._diagnose()
+                command_id = await self._submit_command(code)
+        else:
+            await self._diagnose()
+            command_id = await self._submit_command(code)
+
+        logger.info(f"Command {command_id} submitted in {time.time() - started:.3f}s")
+        if timeout is None:
+            timeout = self.config.command_timeout
+        return await self._wait_for_command(command_id, timeout)
 
     async def _execute_code(
         self,
@@ -236,8 +756,9 @@ class DatabricksMixin(object):
         user_expressions={},
         allow_stdin=False,
         stop_on_error=True,
+        timeout=None,
     ):
-        response = await self._run_command(code)
+        response = await self._run_command(code, timeout)
         logger.warn(str(response)[:200])
 
         if "results" not in response:
@@ -255,21 +776,22 @@ class DatabricksMixin(object):
             cause = results["cause"]
             raise CommandError(summary, cause)
         elif result_type == "table":
-            return {
-                "html": html.table(
-                    results["data"], [x["name"] for x in results["schema"]]
-                )
-            }
+            headers = [x["name"] for x in results["schema"]]
+            self._store_result(results["data"], headers)
+            return {"html": html.table(results["data"], headers)}
         elif result_type == "text":
             return {"text": results["data"]}
         else:
             raise NotImplementedError(f"Not sure how to handle {result_type}.")
 
-    async def _execute_magic(self, cmd, params):
-        if not hasattr(magics, cmd):
+    async def _execute_magic(self, cmd, *params, cell=None):
+        magic = getattr(magics, cmd, None)
+        if not inspect.iscoroutinefunction(magic):
             raise NoSuchMagic(cmd)
 
-        return await getattr(magics, cmd)(self, params)
+        if cell is not None:
+            return await magic(self, *params, cell=cell)
+        return await magic(self, *params)
 
     async def execute_code(
         self,
@@ -280,11 +802,19 @@ class DatabricksMixin(object):
         allow_stdin=False,
         stop_on_error=True,
     ):
-        match_magic = re.match(r"^%(\w+)\s(.+?)$", code)
+        match_cell_magic = re.match(
+            r"^%%(\w+)[ \t]*([^\n]*)\n(.*)$", code.strip(), re.DOTALL
+        )
+        if match_cell_magic:
+            cmd, params, cell = match_cell_magic.groups()
+            return await self._execute_magic(cmd, *shlex.split(params), cell=cell)
+
+        match_magic = re.match(r"^%(\w+)(?:[ \t]+(.*))?$", code.strip())
         if match_magic:
             cmd, params = match_magic.groups()
-            params = re.findall(r"[\"'](.+?)[\"']", params)
-            return await self._execute_magic(cmd, *params)
+            if cmd in magics.RAW_MAGICS:
+                return await self._execute_magic(cmd, (params or "").strip())
+            return await self._execute_magic(cmd, *shlex.split(params or ""))
         else:
             return await self._execute_code(
                 code,
@@ -297,5 +827,24 @@ class DatabricksMixin(object):
 
     async def do_shutdown(self, *args):
         print(args)
-        await self._destroy_context()
-        await self.session.close()
+        content = args[0] if args else {}
+        try:
+            if self.config.reattach_context and content.get("restart"):
+                # keep the context for the restarted kernel to reattach to
+                if self._context_id:
+                    self._save_context(self._context_id)
+            else:
+                await self._destroy_context()
+                if self.config.reattach_context:
+                    self._forget_context()
+        finally:
+            await self.session.close()
+            if self.results:
+                self.results.clear()
+            # files fetched to the default location belong to this kernel only
+            shutil.rmtree(
+                Path(self.config.fetch_local_root).expanduser() / self.engine_id,
+                ignore_errors=True,
+            )
+            if self.daemon:
+                await self.daemon.close()
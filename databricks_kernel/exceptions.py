@@ -38,3 +38,54 @@ class NoSuchMagic(Exception):
 
     def __str__(self):
         return f"No such magic: {self.magic}"
+
+
+class DaemonError(Exception):
+    skip_traceback = True
+
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+
+    def __str__(self):
+        return f"Daemon error ({self.status}): {self.message}"
+
+
+class NoSuchResult(Exception):
+    skip_traceback = True
+
+    def __init__(self, key):
+        self.key = key
+
+    def __str__(self):
+        return f"No stored result for {self.key}"
+
+
+class MissingDependency(Exception):
+    skip_traceback = True
+
+    def __init__(self, package):
+        self.package = package
+
+    def __str__(self):
+        return f"This feature requires {self.package}, please install it."
+
+
+class CommandTimeout(Exception):
+    skip_traceback = True
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"Command cancelled after exceeding its {self.timeout:g}s deadline."
+
+
+class ResizeTimeout(Exception):
+    skip_traceback = True
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"Cluster is still resizing after {self.timeout:g}s."
@@ -12,7 +12,8 @@ import zmq
 from zmq.asyncio import Context
 
 from . import html
-from .exceptions import CommandCanceled, CommandError
+from .comm import CommManager
+from .exceptions import CommandCanceled, CommandError, CommandTimeout
 
 DELIM = b"<IDS|MSG>"
 
@@ -40,14 +41,48 @@ def sign(auth, msgs):
     return str_to_bytes(h.hexdigest())
 
 
+def truncate(text, max_size):
+    """
+    Keep the head and tail of text longer than max_size.
+    """
+    if not max_size or len(text) <= max_size:
+        return text
+
+    half = max_size // 2
+    if not half:
+        return text[:max_size]
+
+    skipped = len(text) - 2 * half
+    return f"{text[:half]}\n... [{skipped} characters truncated] ...\n{text[-half:]}"
+
+
+def split_chunks(text, size):
+    """
+    Split text in chunks of at most size characters, preferably on line breaks.
+    A size of 0 (or less) means no chunking.
+    """
+    while size > 0 and len(text) > size:
+        end = text.rfind("\n", size // 2, size) + 1 or size
+        yield text[:end]
+        text = text[end:]
+    if text:
+        yield text
+
+
 class KernelBase(object):
     version = "2.0.0"
     language = None
     language_version = None
     language_info = None
-    comms = {}
     widgets = {}
     error_timestamp = None
+    parent_header = {}
+
+    iopub_hwm = None
+    stream_chunk_size = 64 * 1024
+    stream_chunk_interval = 0.01
+    stream_max_size = None
+    comm_flush_interval = 0.05
 
     def __init__(self, config):
         self.jupyter_config = config
@@ -61,11 +96,17 @@ class KernelBase(object):
 
         self.engine_id = str(uuid.uuid4())
 
+        self.comms = CommManager()
+        self._comm_pending = {}
+        self._comm_flush = None
+
         self.shell_handlers = {
             "kernel_info_request": self.handle_kernel_info_request,
             "comm_info_request": self.handle_comm_info_request,
             "execute_request": self.handle_execute_request,
             "comm_msg": self.handle_comm_msg,
+            "comm_open": self.handle_comm_open,
+            "comm_close": self.handle_comm_close,
         }
 
         self.control_handlers = {
@@ -74,24 +115,25 @@ class KernelBase(object):
         }
 
         self.execution_count = 0
+        self.execute_queue = asyncio.Queue()
+        self.execution_idle = asyncio.Event()
+        self.execution_idle.set()
 
     async def _receive(self, sock):
-        raw_msg = await sock.recv_multipart()
+        frames = await sock.recv_multipart(copy=False)
+        delim = next(i for i, f in enumerate(frames) if f.bytes == DELIM)
 
-        [
-            ids,
-            _del,
-            _sig,
-            raw_header,
-            _parent_header,
-            _metadata,
-            raw_content,
-            *_,
-        ] = raw_msg
+        ids = frames[0].bytes
+        raw_header, _parent_header, _metadata, raw_content = [
+            f.bytes for f in frames[delim + 2 : delim + 6]
+        ]
         header = json.loads(raw_header)
         content = json.loads(raw_content)
 
-        return ids, header, content
+        # binary buffers are passed on as memoryviews, without copying
+        buffers = [f.buffer for f in frames[delim + 6 :]]
+
+        return ids, header, content, buffers
 
     async def _init_heartbeat_channel(self):
         sock = ctx.socket(zmq.REP)
@@ -104,11 +146,13 @@ class KernelBase(object):
 
     async def _init_iopub_channel(self):
         self.iopub = ctx.socket(zmq.PUB)
+        if self.iopub_hwm:
+            self.iopub.sndhwm = self.iopub_hwm
         self.iopub.bind(f"{self.base_url}:{self.jupyter_config.iopub_port}")
         logger.info("IOPUB socket initialized")
         self.publish_status("starting")
         while True:
-            ids, header, content = await self._receive(self.iopub)
+            ids, header, content, buffers = await self._receive(self.iopub)
 
     async def _init_shell_channel(self):
         self.shell = ctx.socket(zmq.ROUTER)
@@ -116,22 +160,44 @@ class KernelBase(object):
         logger.info("Shell socket initialized")
 
         while True:
-            ids, header, content = await self._receive(self.shell)
+            ids, header, content, buffers = await self._receive(self.shell)
             msg_type = header["msg_type"]
-            if msg_type in self.shell_handlers:
-                self.publish_status("busy", header)
-                await self.shell_handlers[msg_type](content, header, ids)
-                self.publish_status("idle", header)
+            if msg_type == "execute_request":
+                # executions run in order on a separate worker, so comm and info
+                # requests are still handled while a command is running
+                self.execute_queue.put_nowait((msg_type, content, header, ids, buffers))
+            elif msg_type in self.shell_handlers:
+                await self._handle_shell(msg_type, content, header, ids, buffers)
             else:
                 logger.warn(f"Unknown shell message type {msg_type}.")
 
+    async def _handle_shell(self, msg_type, content, header, ids, buffers):
+        self.publish_status("busy", header)
+        await self.shell_handlers[msg_type](content, header, ids, buffers=buffers)
+        self.publish_status("idle", header)
+
+    async def _init_execute_worker(self):
+        while True:
+            request = await self.execute_queue.get()
+            self.execution_idle.clear()
+            try:
+                await self._handle_shell(*request)
+            finally:
+                if self.execute_queue.empty():
+                    self.execution_idle.set()
+
+    async def wait_for_idle(self):
+        # the worker may pick up the next request before waiters get to run
+        while not self.execution_idle.is_set():
+            await self.execution_idle.wait()
+
     async def _init_control_channel(self):
         sock = ctx.socket(zmq.ROUTER)
         sock.bind(f"{self.base_url}:{self.jupyter_config.control_port}")
         logger.info("Control socket initialized")
 
         while True:
-            ids, header, content = await self._receive(sock)
+            ids, header, content, buffers = await self._receive(sock)
             msg_type = header["msg_type"]
             if msg_type in self.control_handlers:
                 await self.control_handlers[msg_type](content, header, ids)
@@ -144,13 +210,14 @@ class KernelBase(object):
         logger.info("Stdin socket initialized")
 
         while True:
-            ids, header, content = await self._receive(sock)
+            ids, header, content, buffers = await self._receive(sock)
             logger.warn("iopub {} {} {}".format(ids, header, content))
 
     async def _init_sockets(self):
         await asyncio.gather(
             self._init_iopub_channel(),
             self._init_shell_channel(),
+            self._init_execute_worker(),
             self._init_heartbeat_channel(),
             self._init_control_channel(),
             self._init_stdin_channel(),
@@ -166,9 +233,16 @@ class KernelBase(object):
         self.send(self.iopub, "stream", {"name": "stderr", "text": str(msg)})
 
     def log(self, msg):
-        self.send(self.iopub, "stream", {"name": "stdout", "text": str(msg)})
+        self.send(
+            self.iopub,
+            "stream",
+            {"name": "stdout", "text": str(msg)},
+            parent_header=self.parent_header,
+        )
 
     def start(self):
+        # socket options such as the iopub HWM only apply when set before bind
+        self.load_config()
         loop = asyncio.get_event_loop()
         loop.set_debug(True)
         loop.run_until_complete(self._init_sockets())
@@ -182,7 +256,13 @@ class KernelBase(object):
         ids=None,
         username="kernel",
         metadata={},
+        buffers=None,
     ):
+        """
+        Send a message. Buffers (bytes, memoryviews or other buffer-protocol
+        objects) are appended as extra frames without copying, so they must not
+        be modified after being passed in.
+        """
         header = {
             "date": datetime.datetime.now().isoformat(),
             "msg_id": str(uuid.uuid4()),
@@ -203,21 +283,70 @@ class KernelBase(object):
         if ids:
             parts = [ids] + parts
 
-        sock.send_multipart(parts)
+        if buffers:
+            sock.send_multipart(parts + list(buffers), copy=False)
+        else:
+            sock.send_multipart(parts)
 
-    def send_comm_message(self, target, msg):
-        comms = [
-            comm_id for comm_id, comm in self.comms.items() if comm.target == target
-        ]
-        for comm_id in comms:
-            self.send(self.iopub, "comm_msg", {"comm_id": comm_id, "data": msg})
+    def _send_comm(self, target, msg, buffers=None):
+        for comm in self.comms.for_target(target):
+            self.send(
+                self.iopub,
+                "comm_msg",
+                {"comm_id": comm.uuid, "data": msg},
+                buffers=buffers,
+            )
 
-    async def handle_comm_info_request(self, content, headers, ids):
-        target = content["target_name"]
+    def send_comm_message(self, target, msg, buffers=None):
+        """
+        Queue a message for all comms of target. Messages queued within
+        comm_flush_interval are sent together, see _flush_comm_messages.
+        """
+        if buffers:
+            self._send_comm(target, msg, buffers)
+            return
+
+        self._comm_pending.setdefault(target, []).append(msg)
+        if not self._comm_flush:
+            self._comm_flush = asyncio.get_event_loop().call_later(
+                self.comm_flush_interval, self._flush_comm_messages
+            )
+
+    def send_comm_batch(self, target, msgs, buffers=None):
+        """
+        Send several updates (e.g. table pages) to target as one framed message.
+        """
+        self._send_comm(target, {"batch": list(msgs)}, buffers)
+
+    def _flush_comm_messages(self):
+        pending, self._comm_pending = self._comm_pending, {}
+        self._comm_flush = None
+
+        for target, msgs in pending.items():
+            self._send_pending(target, msgs)
+
+    def _send_pending(self, target, msgs):
+        if len(msgs) == 1:
+            self._send_comm(target, msgs[0])
+        elif target in self.comms.merge:
+            self._send_comm(target, self.comms.merge[target](msgs))
+        else:
+            self.send_comm_batch(target, msgs)
+
+    def _settle_pending(self, target):
+        """
+        Resolve queued messages for target before a reply goes out, so they
+        can't arrive after it. Queued snapshots are older than the reply and
+        are dropped; other messages are sent right away.
+        """
+        msgs = self._comm_pending.pop(target, [])
+        if msgs and target not in self.comms.merge:
+            self._send_pending(target, msgs)
+
+    async def handle_comm_info_request(self, content, headers, ids, buffers=None):
         comms = {
             x.uuid: {"target_name": x.target}
-            for x in self.comms.values()
-            if x.target == target
+            for x in self.comms.for_target(content.get("target_name"))
         }
         self.send(
             self.shell,
@@ -228,19 +357,35 @@ class KernelBase(object):
             username="username",
         )
 
-    async def handle_comm_msg(self, content, headers, ids):
+    async def handle_comm_open(self, content, headers, ids, buffers=None):
+        comm_id = content["comm_id"]
+        target = content["target_name"]
+
+        if target not in self.comms.handlers:
+            logger.warn(f"Unknown comm target {target}.")
+            self.send(self.iopub, "comm_close", {"comm_id": comm_id}, headers, ids)
+            return
+
+        self.comms.open(target, comm_id)
+
+    async def handle_comm_close(self, content, headers, ids, buffers=None):
+        self.comms.close(content["comm_id"])
+
+    async def handle_comm_msg(self, content, headers, ids, buffers=None):
         comm_id = content["comm_id"]
 
         if comm_id not in self.comms:
             return
 
-        r = await self.comms[comm_id].on_recv(content, headers, ids)
+        comm = self.comms[comm_id]
+        r = await comm.on_recv(content, headers, ids, buffers)
         if r:
+            self._settle_pending(comm.target)
             self.send(
                 self.iopub, "comm_msg", {"comm_id": comm_id, "data": r}, headers, ids
             )
 
-    async def handle_kernel_info_request(self, content, headers, ids):
+    async def handle_kernel_info_request(self, content, headers, ids, buffers=None):
         response = {
             "protocol_version": "5.3",
             "implemention": "databricks",
@@ -264,19 +409,29 @@ class KernelBase(object):
             ids,
         )
 
-    def print_stdout(self, msg, headers, ids):
-        self.send(
-            self.iopub, "stream", {"name": "stdout", "text": msg}, headers, ids,
-        )
+    async def stream(self, name, text, headers, ids):
+        """
+        Send text to iopub in bounded chunks, yielding between chunks so large
+        outputs render progressively and don't overrun the high-water mark.
+        """
+        text = truncate(text, self.stream_max_size)
+        for i, chunk in enumerate(split_chunks(text, self.stream_chunk_size)):
+            if i:
+                await asyncio.sleep(self.stream_chunk_interval)
+            self.send(
+                self.iopub, "stream", {"name": name, "text": chunk}, headers, ids,
+            )
 
-    def print_stderr(self, msg, headers, ids):
-        self.send(
-            self.iopub, "stream", {"name": "stderr", "text": msg}, headers, ids,
-        )
+    async def print_stdout(self, msg, headers, ids):
+        await self.stream("stdout", msg, headers, ids)
+
+    async def print_stderr(self, msg, headers, ids):
+        await self.stream("stderr", msg, headers, ids)
 
-    async def handle_execute_request(self, content, headers, ids):
+    async def handle_execute_request(self, content, headers, ids, buffers=None):
         self.execution_count += 1
         self.interrupt_execution = False
+        self.parent_header = headers
 
         queue_time = datetime.datetime.strptime(
             headers["date"], "%Y-%m-%dT%H:%M:%S.%f%z"
@@ -292,19 +447,23 @@ class KernelBase(object):
             status = "ok"
             print(msg)
             if "text" in msg:
-                self.print_stdout(str(msg.get("text")), headers, ids)
+                await self.print_stdout(str(msg.get("text")), headers, ids)
             if "html" in msg:
                 self.display_data(msg.get("html"), headers, ids)
 
+        except CommandTimeout as e:
+            status = "error"
+            await self.print_stderr(str(e), headers, ids)
+
         except CommandCanceled:
             status = "abort"
-            self.print_stderr("Command canceled.", headers, ids)
+            await self.print_stderr("Command canceled.", headers, ids)
 
         except CommandError as e:
             if e.summary and e.cause:
                 self.display_data(html.stacktrace(e.summary, e.cause), headers, ids)
             else:
-                self.print_stderr(e.cause, headers, ids)
+                await self.print_stderr(e.cause, headers, ids)
             status = "error"
 
         except Exception as e:
@@ -314,7 +473,7 @@ class KernelBase(object):
 
             status = "error"
 
-            self.print_stderr(msg, headers, ids)
+            await self.print_stderr(msg, headers, ids)
 
         self.send(
             self.shell,
@@ -342,5 +501,8 @@ class KernelBase(object):
 
         raise NotImplementedError()
 
+    def load_config(self):
+        pass
+
     async def init_session(self):
         raise NotImplementedError()
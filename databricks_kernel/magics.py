@@ -1,8 +1,28 @@
+import asyncio
 import json
+import shlex
+import tempfile
+import time
 from pathlib import Path
 
 import os
 
+from . import html, sync as sync_utils, transfer
+from .exceptions import MissingDependency
+from .result_store import to_rows
+
+PANDAS_READERS = {
+    ".csv": "read_csv",
+    ".json": "read_json",
+    ".xlsx": "read_excel",
+    ".pkl": "read_pickle",
+    ".pickle": "read_pickle",
+    ".feather": "read_feather",
+}
+
+# magics that get the rest of the line verbatim instead of shell-split arguments
+RAW_MAGICS = {"fetch"}
+
 
 async def run(kernel, filename, *args):
     filename = Path(filename).with_suffix(".ipynb")
@@ -19,3 +39,267 @@ async def run(kernel, filename, *args):
         response = await kernel.execute_code(code)
 
     return response
+
+
+async def result(kernel, key=None, offset=0, limit=100, sort=None, *args):
+    """
+    %result [n] [offset] [limit] [sort]: re-render a stored table result from
+    disk. Prefix the sort column with - to sort descending.
+    """
+    if not kernel.results:
+        raise MissingDependency("pyarrow")
+
+    key = int(key) if key is not None else kernel.results.last
+    table = kernel.results.get(key)
+
+    if sort:
+        order = "descending" if sort.startswith("-") else "ascending"
+        table = table.sort_by([(sort.lstrip("-"), order)])
+
+    offset, limit = int(offset), int(limit)
+    page = table.slice(offset, limit)
+    return {
+        "text": f"Result {key}: rows {offset}-{offset + page.num_rows} "
+        f"of {table.num_rows}",
+        "html": html.table(to_rows(page), page.column_names),
+    }
+
+
+async def sync(kernel, local_dir, remote_root=None, *args):
+    """
+    %sync <local_dir> [remote_root]: upload changed files of a local package to
+    DBFS and make it importable in the remote context. The package is uploaded
+    to <remote_root>/<name of local_dir>, so it keeps its import name.
+    """
+    if kernel.language != "python":
+        raise NotImplementedError("%sync is only supported for python.")
+
+    root = Path(local_dir).expanduser().resolve()
+    if not root.is_dir():
+        raise NotADirectoryError(root)
+
+    remote_dir = f"{remote_root or kernel.config.sync_root}/{root.name}"
+    manifest_key = f"{kernel.config.uri}:{remote_dir}"
+
+    manifest = sync_utils.load_manifest(manifest_key)
+    hashes = sync_utils.hash_tree(root)
+    changed = [f for f, h in hashes.items() if manifest.get(f) != h]
+    deleted = [f for f in manifest if f not in hashes]
+
+    semaphore = asyncio.Semaphore(kernel.config.sync_concurrency)
+
+    async def upload(f):
+        async with semaphore:
+            await kernel._dbfs_put(f"{remote_dir}/{f}", (root / f).read_bytes())
+
+    async def delete(f):
+        async with semaphore:
+            await kernel._dbfs("delete", path=f"{remote_dir}/{f}")
+
+    await asyncio.gather(*map(upload, changed), *map(delete, deleted))
+    sync_utils.save_manifest(manifest_key, hashes)
+
+    await kernel._execute_code(
+        sync_utils.reload_code(root, remote_dir, changed), timeout=0
+    )
+
+    return {
+        "text": f"Synced {root} to dbfs:{remote_dir} ({len(changed)} changed, "
+        f"{len(deleted)} deleted, {len(hashes) - len(changed)} unchanged)."
+    }
+
+
+def _to_parquet(local_path, target):
+    try:
+        import pandas
+    except ImportError:
+        raise MissingDependency("pandas")
+
+    reader = PANDAS_READERS.get(local_path.suffix.lower())
+    if not reader:
+        raise ValueError(f"Can not convert {local_path.suffix} files to parquet.")
+
+    getattr(pandas, reader)(local_path).to_parquet(target)
+
+
+async def upload(kernel, local_path, *params):
+    """
+    %upload <local_path> [remote_path] [--parquet]: upload a local file to DBFS
+    in concurrent segments. With --parquet, the file is first loaded with pandas
+    and uploaded as parquet.
+    """
+    local_path = Path(local_path).expanduser()
+    if not local_path.is_file():
+        raise FileNotFoundError(local_path)
+
+    to_parquet = "--parquet" in params
+    params = [p for p in params if p != "--parquet"]
+    name = local_path.with_suffix(".parquet").name if to_parquet else local_path.name
+    remote_path = params[0] if params else f"{kernel.config.upload_root}/{name}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if to_parquet:
+            source = Path(tmp) / name
+            # loading and converting is slow, keep it off the event loop
+            await asyncio.get_event_loop().run_in_executor(
+                None, _to_parquet, local_path, source
+            )
+        else:
+            source = local_path
+
+        size = source.stat().st_size
+        parts = transfer.segments(
+            size, kernel.config.upload_concurrency, transfer.DBFS_BLOCK_SIZE
+        )
+        paths = (
+            [f"{remote_path}.parts/{i:05d}" for i in range(len(parts))]
+            if len(parts) > 1
+            else [remote_path]
+        )
+
+        progress = transfer.Progress(kernel, size, "Uploaded")
+        try:
+            # let all segments finish before cleaning up after a failed one
+            uploads = await asyncio.gather(
+                *[
+                    kernel._dbfs_write_file(path, source, offset, length, progress)
+                    for path, (offset, length) in zip(paths, parts)
+                ],
+                return_exceptions=True,
+            )
+            for e in uploads:
+                if isinstance(e, BaseException):
+                    raise e
+
+            if len(parts) > 1:
+                await kernel._execute_code(
+                    transfer.concat_code(kernel.language, remote_path, paths),
+                    timeout=0,
+                )
+        finally:
+            if len(parts) > 1:
+                await kernel._dbfs(
+                    "delete", path=f"{remote_path}.parts", recursive=True
+                )
+
+    return {"text": f"{progress}\nUploaded {local_path} to dbfs:{remote_path}"}
+
+
+async def fetch(kernel, line):
+    """
+    %fetch <dataframe expression> [--to <local_dir>]: write a dataframe to DBFS
+    and download it with concurrent ranged reads into local parquet files. The
+    result is also kept in the result store, so it can be paged with %result.
+    """
+    expression, to, local_dir = line.rpartition(" --to ")
+    if to:
+        local_dir = shlex.split(local_dir)
+        if len(local_dir) != 1:
+            raise ValueError("--to takes a single directory.")
+        local_dir = local_dir[0]
+    else:
+        expression, local_dir = line, None
+    expression = expression.strip()
+    if not expression:
+        raise ValueError("%fetch needs a dataframe expression.")
+
+    key = kernel.execution_count
+    remote_dir = f"{kernel.config.fetch_root}/{kernel.engine_id}/{key}"
+    local_dir = Path(
+        local_dir or Path(kernel.config.fetch_local_root) / kernel.engine_id / str(key)
+    ).expanduser()
+    local_dir.mkdir(parents=True, exist_ok=True)
+
+    await kernel._execute_code(transfer.write_code(expression, remote_dir), timeout=0)
+
+    listing = await kernel._dbfs("list", path=remote_dir)
+    files = [
+        f
+        for f in listing.get("files", [])
+        if not f["is_dir"] and f["path"].endswith(".parquet")
+    ]
+
+    semaphore = asyncio.Semaphore(kernel.config.fetch_concurrency)
+    progress = transfer.Progress(kernel, sum(f["file_size"] for f in files), "Fetched")
+
+    async def read(path, target, offset, length):
+        async with semaphore:
+            data = await kernel._dbfs_read(path, offset, length)
+        target.write(offset, data)
+        progress.update(len(data))
+
+    targets = []
+    try:
+        reads = []
+        for f in files:
+            target = transfer.MappedFile(
+                local_dir / Path(f["path"]).name, f["file_size"]
+            )
+            targets.append(target)
+            reads += [
+                read(f["path"], target, offset, length)
+                for offset, length in transfer.ranges(
+                    f["file_size"], transfer.DBFS_BLOCK_SIZE
+                )
+            ]
+        await asyncio.gather(*reads)
+    finally:
+        for target in targets:
+            target.close()
+
+    await kernel._dbfs("delete", path=remote_dir, recursive=True)
+
+    text = f"{progress}\nFetched to {local_dir}"
+    if kernel.results:
+        import pyarrow.dataset
+
+        dataset = pyarrow.dataset.dataset(str(local_dir), format="parquet")
+        kernel.results.put_batches(key, dataset.schema, dataset.to_batches())
+        text += f", page with %result {key}"
+
+    return {"text": text}
+
+
+async def timeout(kernel, seconds, *args, cell=None):
+    """
+    %%timeout <seconds>: run the cell and cancel it when it takes longer. A
+    timeout of 0 runs the cell without the default deadline.
+    """
+    if cell is None:
+        raise ValueError("%%timeout must be on the first line of a cell.")
+
+    return await kernel._execute_code(cell, timeout=float(seconds))
+
+
+def _describe_size(size):
+    if "autoscale" in size:
+        autoscale = size["autoscale"]
+        return f"{autoscale['min_workers']}-{autoscale['max_workers']} (autoscaling)"
+    return str(size["num_workers"])
+
+
+async def scale(kernel, workers, *args, cell=None):
+    """
+    %scale <workers>: resize the cluster and wait until it is done. As a cell
+    magic, %%scale resizes the cluster for the cell only and restores the
+    previous size, fixed or autoscaling, afterwards.
+    """
+    cluster_id = kernel.config.cluster_id
+    size = {"num_workers": int(workers)}
+
+    if cell is None:
+        previous = await kernel._resize_cluster(cluster_id, size)
+        return {
+            "text": f"Resized cluster from {_describe_size(previous)} "
+            f"to {workers} workers."
+        }
+
+    requested = time.time()
+    previous = await kernel._resize_cluster(cluster_id, size, wait=False)
+    try:
+        # restore the size even when waiting for the resize fails
+        if previous != size:
+            await kernel._wait_for_resize(cluster_id, requested)
+        return await kernel._execute_code(cell)
+    finally:
+        await kernel._resize_cluster(cluster_id, previous, wait=False)
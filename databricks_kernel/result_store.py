@@ -0,0 +1,101 @@
+import os
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+from .exceptions import MissingDependency, NoSuchResult
+
+RESULTS_PATH = Path.home() / ".jupyter" / "databricks_results"
+
+
+def to_arrow(data, headers):
+    """
+    Convert row based results from the commands API to an arrow table.
+    Columns with mixed types are stored as strings.
+    """
+    columns = list(zip(*data)) if data else [[] for _ in headers]
+    arrays = []
+    for column in columns:
+        try:
+            arrays.append(pa.array(column))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays.append(pa.array([None if x is None else str(x) for x in column]))
+
+    return pa.Table.from_arrays(arrays, names=headers)
+
+
+def to_rows(table):
+    return list(zip(*[column.to_pylist() for column in table.columns]))
+
+
+class ResultStore(object):
+    """
+    Size bounded store of result sets on disk, using the arrow IPC file format
+    so results can be memory-mapped instead of loaded into memory. The least
+    recently used results are evicted first.
+    """
+
+    def __init__(self, path, max_size):
+        if pa is None:
+            raise MissingDependency("pyarrow")
+
+        self.path = Path(path)
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        # most recently stored key; entries is ordered by use for eviction
+        self.last = None
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _file(self, key):
+        return self.path / f"{key}.arrow"
+
+    @property
+    def size(self):
+        return sum(self.entries.values())
+
+    def put(self, key, table):
+        self.put_batches(key, table.schema, table.to_batches())
+
+    def put_batches(self, key, schema, batches):
+        """
+        Store record batches one at a time, so a result never has to be in
+        memory as a whole.
+        """
+        tmp = self.path / f"{key}.arrow.tmp"
+        with pa.OSFile(str(tmp), "wb") as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                for batch in batches:
+                    writer.write_batch(batch)
+        os.replace(tmp, self._file(key))
+
+        self.entries[key] = self._file(key).stat().st_size
+        self.entries.move_to_end(key)
+        self.last = key
+        self._evict()
+
+    def put_rows(self, key, data, headers):
+        self.put(key, to_arrow(data, headers))
+
+    def get(self, key):
+        if key not in self.entries:
+            raise NoSuchResult(key)
+
+        self.entries.move_to_end(key)
+        # the table keeps the mapped region alive after the file is closed
+        with pa.memory_map(str(self._file(key))) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def _evict(self):
+        while len(self.entries) > 1 and self.size > self.max_size:
+            key, _ = self.entries.popitem(last=False)
+            self._file(key).unlink()
+
+    def clear(self):
+        self.entries.clear()
+        self.last = None
+        shutil.rmtree(self.path, ignore_errors=True)
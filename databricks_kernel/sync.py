@@ -0,0 +1,89 @@
+import hashlib
+import json
+from pathlib import Path
+
+MANIFEST_PATH = Path.home() / ".jupyter" / "databricks_sync.json"
+
+RELOAD_TEMPLATE = """
+import importlib
+import sys
+
+if {path!r} not in sys.path:
+    sys.path.insert(0, {path!r})
+importlib.invalidate_caches()
+for _name in {modules!r}:
+    if _name in sys.modules:
+        importlib.reload(sys.modules[_name])
+"""
+
+
+def hash_tree(root):
+    """
+    Return a {relative path: sha256} mapping of all files below root,
+    skipping hidden files and byte code.
+    """
+    hashes = {}
+    for path in sorted(root.rglob("*")):
+        relative = path.relative_to(root)
+        if not path.is_file() or path.suffix == ".pyc":
+            continue
+        if any(part.startswith(".") or part == "__pycache__" for part in relative.parts):
+            continue
+        hashes[relative.as_posix()] = hashlib.sha256(path.read_bytes()).hexdigest()
+
+    return hashes
+
+
+def module_names(root, files):
+    """
+    Map changed python files to the module names they are imported as,
+    including the packages containing them.
+    """
+    prefix = [root.name] if (root / "__init__.py").exists() else []
+    names = set()
+    for f in files:
+        path = Path(f)
+        if path.suffix != ".py":
+            continue
+        parts = prefix + list(path.with_suffix("").parts)
+        if parts[-1] == "__init__":
+            parts = parts[:-1]
+        # packages bind their submodules' names at import time
+        for i in range(1, len(parts) + 1):
+            names.add(".".join(parts[:i]))
+
+    # reload submodules before the packages importing from them
+    return sorted(names, key=lambda x: (-x.count("."), x))
+
+
+def reload_code(root, remote_dir, files):
+    path = f"/dbfs{remote_dir}"
+    if (root / "__init__.py").exists():
+        path = str(Path(path).parent)
+    modules = module_names(root, files)
+    return RELOAD_TEMPLATE.format(path=path, modules=modules)
+
+
+def load_manifest(key):
+    if not MANIFEST_PATH.exists():
+        return {}
+
+    with MANIFEST_PATH.open() as f:
+        try:
+            return json.load(f).get(key, {})
+        except ValueError:
+            return {}
+
+
+def save_manifest(key, hashes):
+    manifests = {}
+    if MANIFEST_PATH.exists():
+        with MANIFEST_PATH.open() as f:
+            try:
+                manifests = json.load(f)
+            except ValueError:
+                pass
+
+    manifests[key] = hashes
+    with MANIFEST_PATH.open("w") as f:
+        json.dump(manifests, f)
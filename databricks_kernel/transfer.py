@@ -0,0 +1,118 @@
+import mmap
+import time
+
+MB = 1024 * 1024
+
+# maximum payload of dbfs/put and dbfs/add-block
+DBFS_BLOCK_SIZE = MB
+
+CONCAT_TEMPLATES = {
+    "python": """
+import shutil
+
+with open({target!r}, "wb") as _out:
+    for _part in {parts!r}:
+        with open(_part, "rb") as _f:
+            shutil.copyfileobj(_f, _out)
+""",
+    "scala": """
+import java.nio.file.{{Files, Paths}}
+
+val _out = Files.newOutputStream(Paths.get("{target}"))
+try {{
+  for (_part <- Seq({parts})) Files.copy(Paths.get(_part), _out)
+}} finally {{
+  _out.close()
+}}
+""",
+}
+
+
+def segments(size, count, block_size):
+    """
+    Split size bytes in at most count contiguous (offset, length) segments,
+    aligned to block_size.
+    """
+    blocks = -(-size // block_size)
+    per_segment = -(-blocks // count) * block_size if blocks else block_size
+    return [
+        (offset, min(per_segment, size - offset))
+        for offset in range(0, size, per_segment)
+    ] or [(0, 0)]
+
+
+def ranges(size, block_size):
+    return [
+        (offset, min(block_size, size - offset))
+        for offset in range(0, size, block_size)
+    ]
+
+
+def write_code(expression, path):
+    """
+    Code to write the dataframe expression to DBFS as parquet, valid in both
+    python and scala.
+    """
+    return f'({expression}).write.mode("overwrite").parquet("dbfs:{path}")'
+
+
+def concat_code(language, target, parts):
+    target = f"/dbfs{target}"
+    parts = [f"/dbfs{p}" for p in parts]
+    if language == "scala":
+        return CONCAT_TEMPLATES["scala"].format(
+            target=target, parts=", ".join(f'"{p}"' for p in parts)
+        )
+    return CONCAT_TEMPLATES["python"].format(target=target, parts=parts)
+
+
+class MappedFile(object):
+    """
+    Preallocated local file that ranges can be written to in any order.
+    """
+
+    def __init__(self, path, size):
+        self.size = size
+        self.file = open(path, "wb+")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size) if size else None
+
+    def write(self, offset, data):
+        self.map[offset : offset + len(data)] = data
+
+    def close(self):
+        if self.map:
+            self.map.flush()
+            self.map.close()
+        self.file.close()
+
+
+class Progress(object):
+    """
+    Report progress and throughput of a transfer to the kernel log.
+    """
+
+    interval = 2
+
+    def __init__(self, kernel, total, verb):
+        self.kernel = kernel
+        self.total = total
+        self.verb = verb
+        self.done = 0
+        self.started = self.reported = time.time()
+
+    @property
+    def throughput(self):
+        return self.done / MB / max(time.time() - self.started, 1e-3)
+
+    def update(self, n):
+        self.done += n
+        if time.time() - self.reported > self.interval:
+            self.reported = time.time()
+            self.kernel.log(f"{self}\n")
+
+    def __str__(self):
+        return (
+            f"{self.verb} {self.done / MB:.1f}/{self.total / MB:.1f} MB "
+            f"({self.throughput:.1f} MB/s)"
+        )
@@ -24,3 +24,24 @@ class Config(objectview):
     api_key = None
     databricks_url = None
     cluster_id = None
+    daemon_socket = None
+    autostart_cluster = False
+    warmup_cluster = False
+    cluster_state_ttl = 15
+    poll_min_interval = 0.05
+    poll_max_interval = 1
+    reattach_context = False
+    context_ttl = 24 * 60 * 60
+    command_timeout = None
+    iopub_hwm = None
+    stream_chunk_size = None
+    stream_chunk_interval = None
+    stream_max_size = None
+    result_store_size = 512 * 1024 ** 2
+    sync_root = "/FileStore/jupyter/sync"
+    sync_concurrency = 8
+    upload_root = "/FileStore/jupyter/uploads"
+    upload_concurrency = 4
+    fetch_root = "/FileStore/jupyter/fetch"
+    fetch_local_root = "~/.jupyter/databricks_fetch"
+    fetch_concurrency = 8